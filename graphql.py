@@ -2,6 +2,15 @@ import requests
 import json
 import pandas as pd
 
+# optional: pip install ijson to decode listing results as they stream in.
+# this roughly halves peak memory on large viewports but is no faster than
+# json.loads, even with the C backend (yajl2_c); the pure python backend is
+# much slower. without ijson the whole body is decoded with json.loads.
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 
 def listingsearch(keywords,near=""):
     gqlvar = locals()
@@ -71,17 +80,102 @@ def listingsearch(keywords,near=""):
     """    
     #print(gqlvar)
 
-    listr = requests.post("https://waybase.com/graphql", 
-        json= {'query': query, 'variables':gqlvar})
-    
-    r2 = pd.json_normalize(pd.DataFrame(
-                json.loads(listr.text)["data"]["search"]["results"]["edges"]
-                )["node"])
+    # stream the body and decode nodes as they arrive rather than loading the
+    # whole viewport result into memory several times over
+    with requests.post("https://waybase.com/graphql", 
+        json= {'query': query, 'variables':gqlvar}, stream=True) as listr:
+        listr.raise_for_status()
+        if ijson != None:
+            listr.raw.decode_content = True
+            nodes = streamnodes(listr.raw, "data.search.results.edges")
+        else:
+            nodes = loadnodes(listr.text, "data.search.results.edges")
+        r2 = buildcolumns(nodes)
         
 
     
     return r2
 
+def flattennode(node, parent=""):
+    # same column naming and order as pd.json_normalize: plain fields first,
+    # then nested ones flattened, e.g. location.coordinates
+    row = {}
+    nested = {}
+    for key, value in node.items():
+        if isinstance(value, dict) and value:
+            nested.update(flattennode(value, parent + key + "."))
+        else:
+            row[parent + key] = value
+    row.update(nested)
+    return row
+
+def buildcolumns(nodes):
+    # collect nodes straight into column buffers, padding fields missing
+    # from a node with NaN like pd.json_normalize does
+    columns = {}
+    count = 0
+    for node in nodes:
+        row = flattennode(node)
+        for key in row:
+            if key not in columns:
+                columns[key] = [float("nan")] * count
+        for key, col in columns.items():
+            col.append(row.get(key, float("nan")))
+        count += 1
+    
+    return pd.DataFrame(columns)
+
+class HeadStream:
+    # file-like wrapper that keeps the first limit bytes read through it, so
+    # a response with no nodes (normally a short error body) can be checked
+    def __init__(self, stream, limit=65536):
+        self.stream = stream
+        self.limit = limit
+        self.head = b""
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.size += len(data)
+        if len(self.head) < self.limit:
+            self.head += data[:self.limit - len(self.head)]
+        return data
+
+def streamnodes(stream, path):
+    # yield each edge node under path as the C backend builds it. if nothing
+    # comes back, decode the short body to tell an empty result from a
+    # failed query (graphql errors or no edges list)
+    head = HeadStream(stream)
+    found = False
+    for node in ijson.items(head, path + ".item.node", use_float=True):
+        found = True
+        if node != None:
+            yield node
+    
+    if not found:
+        if head.size > head.limit:
+            raise ValueError("no " + path + " in graphql response")
+        loadnodes(head.head.decode("utf-8"), path)
+
+def loadnodes(text, path):
+    # non-streaming fallback when ijson isn't installed
+    body = json.loads(text)
+    edges = body
+    for key in path.split("."):
+        if not isinstance(edges, dict) or edges.get(key) == None:
+            edges = None
+            break
+        edges = edges[key]
+    checkresponse(body.get("errors"), edges != None, path)
+    
+    return [edge["node"] for edge in edges if edge.get("node") != None]
+
+def checkresponse(errors, found, path):
+    if errors:
+        raise ValueError("graphql query failed: " + json.dumps(errors))
+    if not found:
+        raise ValueError("no " + path + " in graphql response")
+
 def locationsearch(near=""):
     
     query = """
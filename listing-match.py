@@ -118,6 +118,17 @@
 * flexability. Removed extraneous options from WB_Match since normal use-case
 * will likely need as much information outputted as possible (old toggles let
 * return as little as just ID or ID and CONF values).
+* 20261018 Improvement: Added WB_Match_Incremental for re-running the same
+* input file month to month. Each row is fingerprinted on its match-relevant
+* fields and only new, edited or previously unmatched rows are re-queried; the
+* rest are carried over from the previous output. Everything is re-queried
+* when the search_profiles index version changes.
+* 20261018 Improvement: Added WB_Match_Batch to split an input dataframe into
+* shards across a process pool. Each worker builds its own Elasticsearch
+* client and keeps one pgeocode lookup table. get_bounds results are now cached
+* and the Nominatim 1/sec limit is enforced through a shared clock, so all
+* workers share one cache and one rate limit. Shards are merged back in the
+* original row order.
 *
 * @author: Stephen J.C. Luehr
 *
@@ -136,6 +147,11 @@ from geopy import Nominatim #Can be changed to GoogleV3
 import re
 from fuzzywuzzy import fuzz #For diagnostic check
 import elasticsearch
+import hashlib
+import json
+import multiprocessing
+import warnings
+import numpy as np
 
 from web_search_template import web_search
 
@@ -143,6 +159,16 @@ from web_search_template import web_search
 #Set the OSM user_agent to any non-default profile.
 locator = Nominatim(user_agent = "WB_Find_Bounds")
 
+#Cache of bounding boxes already returned by the locator, keyed on the search.
+#The clock holds the time of the last locator request so the rate limit holds
+#across calls. WB_Match_Batch swaps both for versions shared by all workers.
+geocode_cache = {}
+geocode_clock = multiprocessing.Value("d", 0.0)
+
+#Offline postal code table and Elasticsearch client, built once per process.
+postal_lookup = None
+worker_client = None
+
 '''
 # Alternatively, can be changed to Google maps service using the format:
 # geopy.geocoders.GoogleV3(api_key=None, domain='maps.googleapis.com',        #
@@ -171,6 +197,23 @@ tqdm.pandas() #Currently throws a FutureWarning. Creator has said they will fix
 # break and maintain functionality.
 
 
+# Column names for the WB_Match output list, in order. Used when the output is
+# stored as a dataframe (see WB_Match_Incremental).
+OUTPUT_COLUMNS = [
+    "ID", "Confidence", "WB_Name", "WB_AKA", "WB_Locality", "PC", "DENOM",
+    "LEV", "CC"
+]
+
+
+# Errors that mean the client itself can't work (bad host, bad login). These
+# stop a run instead of being recorded against a single row.
+CLIENT_ERRORS = (
+    elasticsearch.ConnectionError,
+    elasticsearch.AuthenticationException,
+    elasticsearch.AuthorizationException,
+)
+
+
 #----------------------------------FUNCTIONS----------------------------------#
 #=============================================================================#
 #   Function: ES_Query
@@ -332,17 +375,13 @@ def ES_Query(client, namestring=None, postcode=None, boundaries=None, polygon=No
 def get_bounds(searchstring, RateLimiter = 1):
     #Pull results from OSM Foundation/Google
     #Buffer step to dump if bounding box isn't found.
-    try:
-        location = locator.geocode(searchstring, country_codes = 'ca').raw['boundingbox']
-    except AttributeError:
+    location = locate(searchstring, RateLimiter)
+    if location == None and isinstance(searchstring, str) and "," in searchstring:
         #Try one more time with first portion of address removed for more broad
         #results. Simply check for comma, and pull after the first one.
         searchstring = searchstring[searchstring.index(",")+1:]
         searchstring = searchstring.lstrip(' ')
-        try:
-            location = locator.geocode(searchstring, country_codes = 'ca').raw['boundingbox']
-        except AttributeError:
-            location = None
+        location = locate(searchstring, RateLimiter)
     
     if location == None: #Sets search boundary to Canada at least.
         boundaries = [[None, None],[None, None]]
@@ -359,10 +398,39 @@ def get_bounds(searchstring, RateLimiter = 1):
     boundaries[0][1] = float(location[1])
     boundaries[1][0] = float(location[3])
     boundaries[1][1] = float(location[0])
-    #What the prescribed RateLimiter time to submit the next search.
-    time.sleep(RateLimiter)
     return boundaries
 
+#=============================================================================#
+#    Function: locate
+#
+#    Definition: Single locator request for get_bounds. Returns the raw       #
+# boundingbox list, or None if nothing was found. Results (including misses)  #
+# are cached, so repeated searches never hit the service twice. Requests are  #
+# spaced at least RateLimiter seconds apart using geocode_clock; the clock's  #
+# lock is held while waiting, so parallel workers queue up behind it.         #
+#
+#=============================================================================#
+def locate(searchstring, RateLimiter = 1):
+    key = json.dumps(searchstring, sort_keys=True)
+    if key in geocode_cache:
+        return geocode_cache[key]
+    with geocode_clock.get_lock():
+        # Check again, another worker may have looked it up while we waited.
+        if key in geocode_cache:
+            return geocode_cache[key]
+        wait = geocode_clock.value + RateLimiter - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            location = locator.geocode(searchstring, country_codes = 'ca')
+        finally:
+            geocode_clock.value = time.time()
+        if location != None:
+            location = location.raw['boundingbox']
+        # Stored before releasing the lock so nobody queued repeats it.
+        geocode_cache[key] = location
+    return location
+
 def normalize_postalcode(PC):
     # If not a string, throw it back.
     if PC == None or type(PC) == float:
@@ -441,6 +509,20 @@ def get_cluster(results, epsilon = 4):
     results = pd.concat([results, clusters], axis=1)
     return results
 
+#=============================================================================#
+#    Function: get_postal_lookup
+#
+#    Definition: Returns the pgeocode table for Canada, loading it once per   #
+# process. It's a large table, and on first use pgeocode downloads and writes #
+# its cache file, so it must not be loaded by many processes at once.         #
+#
+#=============================================================================#
+def get_postal_lookup():
+    global postal_lookup
+    if postal_lookup is None:
+        postal_lookup = pgeocode.Nominatim("ca")
+    return postal_lookup
+
 #=============================================================================#
 #    Function: get_geocode
 #
@@ -466,7 +548,7 @@ def get_geocode(location):
         return None
     # Set search database to use the Nominatim offline database in pgeocode.
     # "ca" indicates canada only. Significantly speeds up search and quality.
-    nomi = pgeocode.Nominatim("ca")
+    nomi = get_postal_lookup()
     # Clean input. Some postal codes lack a space, which causes error.
     location = normalize_postalcode(location)
     if zipCode.match(location): # Check if valid canadian postal code.
@@ -502,6 +584,8 @@ def WB_Match(
         try:
             results = ES_Query(client, namestring, postcode, boundaries, polygon)
         except elasticsearch.TransportError:
+            if attempts == 2: #Out of retries, pass the real error on.
+                raise
             continue
         else:
             break
@@ -607,4 +691,410 @@ def WB_Match(
             OutputList.append(DiagnosticDictionary[i])
 
 
-    return OutputList
\ No newline at end of file
+    return OutputList
+
+
+#=============================================================================#
+#    Function: get_index_version
+#
+#    Definition: Returns a string identifying the concrete index currently    #
+# behind the search_profiles alias (index name and uuid). A reindex or alias  #
+# swap changes this value, which WB_Match_Incremental uses to decide that all #
+# previous matches are stale.                                                 #
+#
+#   Parameters:
+#       client: the Elasticsearch client with login information. REQUIRED.
+#
+#       index: Default "search_profiles". The index or alias being queried.
+#
+#=============================================================================#
+def get_index_version(client, index="search_profiles"):
+    settings = client.indices.get_settings(index=index)
+    versions = []
+    for name in sorted(settings):
+        versions.append(name + ":" + settings[name]["settings"]["index"]["uuid"])
+    return ",".join(versions)
+
+#=============================================================================#
+#    Function: get_fingerprint
+#
+#    Definition: Hashes the fields that WB_Match actually uses for a single   #
+# input row. Postal codes are normalized first so that reformatting a postal  #
+# code in the source file (adding a space, changing case) does not count as   #
+# an edit. Blank cells (None or NaN) hash the same.                           #
+#
+#   Parameters: Same as WB_Match, minus the client.
+#
+#=============================================================================#
+def get_fingerprint(namestring=None, postcode=None, boundaries=None,
+                    polygon=None, epsilon=4):
+    fields = [
+        namestring,
+        normalize_postalcode(postcode),
+        boundaries,
+        polygon,
+        epsilon,
+    ]
+    # NaN from empty pandas cells is treated the same as None.
+    fields = [None if isinstance(f, float) and f != f else f for f in fields]
+    fields = json.dumps(fields, sort_keys=True, default=str)
+    return hashlib.sha1(fields.encode("utf-8")).hexdigest()
+
+#=============================================================================#
+#    Function: get_cell
+#
+#    Definition: Pulls a WB_Match argument out of a dataframe row, turning    #
+# blank cells (NaN) and missing column names into None.                       #
+#
+#=============================================================================#
+def get_cell(row, col):
+    if col == None:
+        return None
+    value = row[col]
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+#=============================================================================#
+#    Function: match_row
+#
+#    Definition: Runs WB_Match on a single dataframe row, reading the         #
+# arguments from the given column names with get_cell.                        #
+#
+#=============================================================================#
+def match_row(client, row, namecol, postcol, boundcol, polycol, epsilon=4):
+    return WB_Match(
+        client,
+        get_cell(row, namecol),
+        get_cell(row, postcol),
+        get_cell(row, boundcol),
+        get_cell(row, polycol),
+        epsilon=epsilon,
+    )
+
+#=============================================================================#
+#    Function: match_rows
+#
+#    Definition: Runs match_row over (index, row) pairs, e.g. from iterrows.  #
+# A row that raises (geopy timeout, repeated TransportErrors etc.) gets a     #
+# None match and its index and error are recorded, so one bad row doesn't     #
+# throw away the rest of a long run. CLIENT_ERRORS are raised as usual since  #
+# every other row would fail the same way. Returns (matches, errors).        #
+#
+#=============================================================================#
+def match_rows(client, rows, namecol, postcol, boundcol, polycol, epsilon=4):
+    matches = []
+    errors = []
+    for idx, row in rows:
+        try:
+            match = match_row(
+                client, row, namecol, postcol, boundcol, polycol, epsilon
+            )
+        except CLIENT_ERRORS:
+            raise
+        except Exception as error:
+            match = None
+            errors.append((idx, repr(error)))
+        matches.append(match)
+    return matches, errors
+
+#=============================================================================#
+#    Function: warn_errors
+#
+#    Definition: Warns with the number of rows match_rows couldn't query and  #
+# the first few of their index labels and errors.                             #
+#
+#=============================================================================#
+def warn_errors(errors, shown=5):
+    if errors:
+        warnings.warn(
+            "%d rows failed and were left unmatched, e.g. %s"
+            % (len(errors), "; ".join("%s: %s" % e for e in errors[:shown]))
+        )
+
+#=============================================================================#
+#    Function: check_columns
+#
+#    Definition: Raises a ValueError if the input dataframe already has any   #
+# of the columns about to be appended to it. A clash (e.g. an input column    #
+# called PC) would give duplicate labels and misalign the carried-over        #
+# results on the next run. Rename the input column first.                     #
+#
+#=============================================================================#
+def check_columns(data, columns):
+    clashes = [col for col in columns if col in data.columns]
+    if clashes:
+        raise ValueError(
+            "Input already has output column(s) " + ", ".join(clashes)
+            + ". Rename them before matching."
+        )
+
+#=============================================================================#
+#    Function: WB_Match_Incremental
+#
+#    Definition: Runs WB_Match over an input dataframe, reusing the results   #
+# of a previous run wherever possible. A row is re-queried only if:           #
+#   - it is new (its index label is not in the previous output),              #
+#   - its match-relevant fields changed (fingerprint differs),                #
+#   - it previously got no confident match (no ID), or its CC is below        #
+#     min_confidence when that is given,                                      #
+#   - the search_profiles index version differs from the previous run.        #
+# Everything else is copied from the previous output. Returns the input       #
+# dataframe with the OUTPUT_COLUMNS plus WB_Fingerprint and WB_IndexVersion   #
+# columns appended. Save that whole dataframe with to_pickle and pass it back #
+# in as 'previous' next month. (to_csv works too, but read it back with       #
+# index_col=0 or the index won't line up.) Rows that raise during the query   #
+# are left unmatched with a warning, so they are re-queried next run.         #
+#
+#   Parameters:
+#       client: the Elasticsearch client with login information. REQUIRED.
+#
+#       data: the input dataframe. Its index identifies rows between runs so
+#             it must be unique and stable (e.g. a record number from the
+#             source file, not a position that shifts when rows are added).
+#
+#       previous: the dataframe returned by the previous run. Default None
+#                 re-queries everything.
+#
+#       namecol, postcol, boundcol, polycol: column names in data holding
+#                 the WB_Match namestring, postcode, boundaries and polygon
+#                 arguments. Only namecol is required.
+#
+#       epsilon: passed on to WB_Match. Part of the fingerprint, so changing
+#                it re-queries every row.
+#
+#       index_version: the current index version. Default None looks it up
+#                      with get_index_version, which needs index metadata
+#                      privileges. With read-only search credentials pass it
+#                      in yourself, otherwise every row is re-queried (with a
+#                      warning).
+#
+#       min_confidence: optional CC threshold. Previous matches with a lower
+#                       CC are re-queried as well.
+#
+#       full: Default False. Set True to re-query every row regardless.
+#
+#   The input must not already contain any OUTPUT_COLUMNS, WB_Fingerprint or
+#   WB_IndexVersion column, and the data and previous indexes must be unique
+#   (ValueError).
+#
+#   DiagnosticDictionary is not supported here since its output columns vary
+#   per call. Use WB_Match directly for diagnostic runs.
+#
+#=============================================================================#
+def WB_Match_Incremental(
+    client,
+    data,
+    previous=None,
+    namecol="name",
+    postcol=None,
+    boundcol=None,
+    polycol=None,
+    epsilon=4,
+    index_version=None,
+    min_confidence=None,
+    full=False
+):
+    check_columns(data, OUTPUT_COLUMNS + ["WB_Fingerprint", "WB_IndexVersion"])
+    if not data.index.is_unique:
+        raise ValueError("data index must be unique to carry results over.")
+    if previous is not None and not previous.index.is_unique:
+        raise ValueError("previous index must be unique to carry results over.")
+
+    if index_version == None:
+        try:
+            index_version = get_index_version(client)
+        except elasticsearch.AuthorizationException:
+            warnings.warn(
+                "Can't read the index version with this client, re-querying "
+                "every row. Pass index_version for read-only credentials."
+            )
+            full = True
+
+    data = data.copy()
+    # Built row by row so an empty input still gives an (empty) column.
+    data["WB_Fingerprint"] = pd.Series(
+        [
+            get_fingerprint(
+                get_cell(row, namecol),
+                get_cell(row, postcol),
+                get_cell(row, boundcol),
+                get_cell(row, polycol),
+                epsilon,
+            )
+            for idx, row in data.iterrows()
+        ],
+        index=data.index,
+        dtype=object,
+    )
+    data["WB_IndexVersion"] = index_version
+
+    output = pd.DataFrame(index=data.index, columns=OUTPUT_COLUMNS, dtype=object)
+
+    if previous is None or full:
+        rematch = pd.Series(True, index=data.index)
+    else:
+        prior = previous.reindex(data.index)
+        rematch = (
+            (prior["WB_Fingerprint"] != data["WB_Fingerprint"])
+            | (prior["WB_IndexVersion"] != index_version)
+            | prior["ID"].isna()
+        )
+        if min_confidence != None:
+            CC = pd.to_numeric(prior["CC"], errors="coerce").fillna(0)
+            rematch = rematch | (CC < min_confidence)
+        # Carry over everything that doesn't need a new query.
+        output.loc[~rematch, OUTPUT_COLUMNS] = prior.loc[~rematch, OUTPUT_COLUMNS]
+
+    todo = data[rematch]
+    matches, errors = match_rows(
+        client,
+        tqdm(
+            todo.iterrows(),
+            total=len(todo.index),
+            desc="Re-querying %d of %d rows" % (len(todo.index), len(data.index)),
+        ),
+        namecol, postcol, boundcol, polycol, epsilon,
+    )
+    for idx, match in zip(todo.index, matches):
+        if match != None:
+            output.loc[idx, OUTPUT_COLUMNS] = match[:len(OUTPUT_COLUMNS)]
+    warn_errors(errors)
+
+    fingerprints = data.pop("WB_Fingerprint")
+    versions = data.pop("WB_IndexVersion")
+    return pd.concat([data, output, fingerprints, versions], axis=1)
+
+#=============================================================================#
+#    Function: init_worker
+#
+#    Definition: Pool initializer for WB_Match_Batch. Installs the shared     #
+# geocode cache and clock and builds this worker's Elasticsearch client. The  #
+# pgeocode table is loaded by the parent before the pool starts (inherited on #
+# fork, loaded lazily from the finished cache file otherwise).                #
+#
+#=============================================================================#
+def init_worker(client_kwargs, cache, clock):
+    global geocode_cache, geocode_clock, worker_client
+    geocode_cache = cache
+    geocode_clock = clock
+    worker_client = elasticsearch.Elasticsearch(**client_kwargs)
+
+#=============================================================================#
+#    Function: match_shard
+#
+#    Definition: Runs WB_Match over one shard inside a worker with            #
+# match_rows. Returns the output lists in the same order as the shard rows,   #
+# plus the (index, error) pairs of rows that raised so the parent can report  #
+# them.                                                                       #
+#
+#=============================================================================#
+def match_shard(shard, namecol, postcol, boundcol, polycol, epsilon):
+    return match_rows(
+        worker_client, shard.iterrows(), namecol, postcol, boundcol, polycol,
+        epsilon,
+    )
+
+#=============================================================================#
+#    Function: WB_Match_Batch
+#
+#    Definition: Runs WB_Match over an input dataframe using a pool of        #
+# worker processes. The dataframe is split into contiguous shards, each       #
+# worker keeps its own Elasticsearch client and pgeocode table, and all       #
+# workers share one bounding box cache and one Nominatim rate limit (so the   #
+# boundaries column still tops out at ~1 lookup/sec overall, but repeated     #
+# addresses are free). Returns the input dataframe with OUTPUT_COLUMNS        #
+# appended, rows in the original order. Rows that raise are left unmatched    #
+# and reported in a single warning; connection and login errors stop the run. #
+#
+#   Call it from a script under an  if __name__ == "__main__":  guard, since  #
+#   worker processes may re-import the calling script.                        #
+#
+#   Parameters:
+#       client_kwargs: dictionary of keyword arguments for
+#                      elasticsearch.Elasticsearch (hosts, http_auth, timeout
+#                      etc.). Clients can't be passed between processes, so
+#                      each worker builds its own from these. REQUIRED.
+#
+#       data: the input dataframe. Must not already contain any of the
+#             OUTPUT_COLUMNS (ValueError). REQUIRED.
+#
+#       namecol, postcol, boundcol, polycol: column names in data holding
+#                 the WB_Match namestring, postcode, boundaries and polygon
+#                 arguments. Only namecol is required.
+#
+#       epsilon: passed on to WB_Match.
+#
+#       processes: Default None uses every core.
+#
+#       shards: Default None uses 4 shards per process so a slow shard
+#               doesn't leave the other cores idle at the end.
+#
+#=============================================================================#
+def WB_Match_Batch(
+    client_kwargs,
+    data,
+    namecol="name",
+    postcol=None,
+    boundcol=None,
+    polycol=None,
+    epsilon=4,
+    processes=None,
+    shards=None
+):
+    check_columns(data, OUTPUT_COLUMNS)
+
+    # Fail fast on a bad host or login rather than returning an all-NaN
+    # output; info() raises one of CLIENT_ERRORS.
+    elasticsearch.Elasticsearch(**client_kwargs).info()
+
+    if processes == None:
+        processes = multiprocessing.cpu_count()
+    if shards == None:
+        shards = processes * 4
+    shards = max(1, min(shards, len(data.index)))
+
+    # Split on position into contiguous shards.
+    bounds = np.array_split(np.arange(len(data.index)), shards)
+    pieces = [data.iloc[b] for b in bounds]
+
+    # Load the postal table here once, not in every worker racing to write
+    # pgeocode's cache file.
+    get_postal_lookup()
+
+    # The manager holds the shared cache; seed it with anything this process
+    # already looked up.
+    with multiprocessing.Manager() as manager:
+        cache = manager.dict(geocode_cache)
+        clock = multiprocessing.Value("d", geocode_clock.value)
+        with multiprocessing.Pool(
+            processes,
+            initializer=init_worker,
+            initargs=(client_kwargs, cache, clock),
+        ) as pool:
+            jobs = [
+                pool.apply_async(
+                    match_shard,
+                    (piece, namecol, postcol, boundcol, polycol, epsilon),
+                )
+                for piece in pieces
+            ]
+            matches = []
+            errors = []
+            # Collect in submission order to keep the original row order.
+            for job in tqdm(jobs):
+                shard_matches, shard_errors = job.get()
+                matches.extend(shard_matches)
+                errors.extend(shard_errors)
+        geocode_cache.update(cache.copy())
+        # Keep the rate limit for lookups made right after the batch.
+        geocode_clock.value = clock.value
+
+    output = pd.DataFrame(
+        [[float("NaN")] * len(OUTPUT_COLUMNS) if match == None
+         else match[:len(OUTPUT_COLUMNS)] for match in matches],
+        columns=OUTPUT_COLUMNS,
+        index=data.index,
+    )
+    warn_errors(errors)
+    return pd.concat([data, output], axis=1)